@@ -2,21 +2,98 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import collections
+import concurrent.futures
 import datetime
+import functools
 import imaplib
 import re
-import itertools
+import threading
+
+# Keep command lines well under server limits such as Dovecot's 64k
+_MAX_MESSAGE_SET_LENGTH = 16384
+
+_FETCH_RESPONSE_RE = re.compile(rb'^\* \d+ FETCH (.*)')
+_FETCH_UID_RE = re.compile(rb'[( ]UID (\d+)')
+_FETCH_YEAR_RE = re.compile(rb'INTERNALDATE "[ \d]\d-[A-Za-z]{3}-(\d{4}) ')
+_ESEARCH_TAG_RE = re.compile(rb'^\(TAG "([^"]*)"\)')
+_ESEARCH_COUNT_RE = re.compile(rb' COUNT (\d+)')
+_ESEARCH_ALL_RE = re.compile(rb' ALL ([\d:,]+)')
+_LIST_RE = re.compile(rb'^\(([^)]*)\) (?:"(?:[^"\\]|\\.)*"|NIL) "?([^"]*)"?$')
+
+def parse_fetch_data(data):
+    """
+    Return the UID and year from the data of a FETCH response, which may
+    list them in either order, or None if either is missing
+    """
+
+    uid = _FETCH_UID_RE.search(data)
+    year = _FETCH_YEAR_RE.search(data)
+
+    if uid is None or year is None:
+        return None
+
+    return int(uid.group(1)), int(year.group(1))
+
+class ArchiverConnection(imaplib.IMAP4_SSL):
+    """IMAP connection able to fetch message years without imaplib's parser."""
+
+    def fetch_message_years(self, message_set):
+        """
+        Fetch the INTERNALDATE of the given messages, reading the response
+        lines directly instead of through imaplib's response handling, and
+        return a list of UID and year pairs
+        """
+
+        tag = self._new_tag()
+        messages = []
+
+        try:
+            self.send(tag + b" UID FETCH " + message_set.encode() + b" (UID INTERNALDATE)\r\n")
+
+            while True:
+                line = self.readline()
+
+                if not line:
+                    raise self.abort("socket error: EOF")
+
+                match = _FETCH_RESPONSE_RE.match(line)
+
+                if match is not None:
+                    message = parse_fetch_data(match.group(1))
+
+                    if message is None:
+                        raise self.error("Could not parse message data: %s" % line.decode("utf-8", "replace").strip())
+
+                    messages.append(message)
+                elif line.startswith(tag + b" "):
+                    break
+                elif line.startswith(b"* BYE"):
+                    raise self.abort(line.decode("utf-8", "replace").strip())
+        finally:
+            del self.tagged_commands[tag]
+
+        if line[len(tag) + 1:len(tag) + 3] != b"OK":
+            raise self.error("UID FETCH failed: %s" % line.decode("utf-8", "replace").strip())
+
+        return messages
 
 class ImapArchiver(object):
     """Archives old messages in IMAP mailboxes."""
 
-    def __init__(self, connection, max_age=365, max_messages=50, archive_mailbox_name="Archives", dry_run=False):
+    def __init__(self, connection, max_age=365, max_messages=50, archive_mailbox_name="Archives", dry_run=False, archive_mailboxes=None, lock=None):
         self.connection = connection
         self.max_age = max_age
         self.max_messages = max_messages
         self.archive_mailbox_name = archive_mailbox_name
-        self.archive_mailboxes = self.get_mailboxes_matching(self.archive_mailbox_name)
-        self.pattern = re.compile('^[0-9]+ \(UID ([0-9]+) INTERNALDATE "([0-9]+-[a-zA-Z]+-[0-9]+ [0-9]+:[0-9]+:[0-9]+ [-\+][0-9]+)')
+
+        # Archivers running in other threads can share the set of archive
+        # mailboxes, along with the lock guarding their creation
+        if archive_mailboxes is None:
+            archive_mailboxes = set(self.get_mailboxes_matching(self.archive_mailbox_name))
+
+        self.archive_mailboxes = archive_mailboxes
+        self.lock = lock or threading.Lock()
         self.now = datetime.datetime.now(datetime.timezone.utc)
         self.dry_run = dry_run
 
@@ -25,71 +102,162 @@ class ImapArchiver(object):
 
         self.select_mailbox(mailbox)
 
-        message_uids = self.get_message_uids()
+        max_date = self.get_max_date()
+        years = range(max_date.year - 1, max_date.year + 1)
 
-        if not message_uids:
-            return
+        # Messages from recent years can be partitioned by searching
+        # each year in turn, so their dates never need to be fetched
+        year_queries = [
+            self.build_search_query(min(datetime.date(year + 1, 1, 1), max_date), datetime.date(year, 1, 1))
+            for year in years
+        ]
+        queries = [self.build_search_query(datetime.date(years[0], 1, 1))]
+
+        year_sets, (message_uids,) = self.search_messages(mailbox, year_queries, queries)
+
+        message_sets = {
+            self.build_archive_mailbox(self.archive_mailbox_name, year, mailbox): (message_set, count)
+            for year, (message_set, count) in zip(years, year_sets) if count
+        }
+        pending = collections.defaultdict(list)
 
+        # Dates are still fetched in pages, but the messages are only
+        # moved once every page has been read so each archive mailbox
+        # needs a single move
         for start in range(0, len(message_uids), self.max_messages):
-            message_uid_row = list(message_uids[start:start+self.max_messages])
-            messages = self.get_messages(message_uid_row, mailbox)
+            message_uid_row = message_uids[start:start+self.max_messages]
 
-            for archive_mailbox, messages in itertools.groupby(messages, key=lambda x:x["mailbox"]):
-                message_uid_row = [message["uid"] for message in messages]
-                self.archive_messages(message_uid_row, mailbox, archive_mailbox)
+            for archive_mailbox, uid in self.get_messages(message_uid_row, mailbox):
+                pending[archive_mailbox].append(uid)
 
-    def archive_messages(self, message_uids, mailbox, archive_mailbox):
-        """Move the messages to the new mailbox, creating it if needed"""
+        # The server's search dates can disagree with the year in a
+        # message's INTERNALDATE offset, so a fetched message may belong
+        # to one of the searched years and must be merged with its set
+        for archive_mailbox, message_uids in pending.items():
+            message_uids.sort()
+            message_set, count = self.build_message_set(message_uids), len(message_uids)
 
-        try:
-            self.archive_mailboxes.index(archive_mailbox)
-        except ValueError:
-            self.create_archive_mailbox(archive_mailbox)
+            if archive_mailbox in message_sets:
+                year_set, year_count = message_sets[archive_mailbox]
+                message_set, count = year_set + "," + message_set, year_count + count
 
-        print("Archiving %d message(s) from %s to %s" % (len(message_uids), mailbox, archive_mailbox))
+            message_sets[archive_mailbox] = (message_set, count)
 
-        message_set = self.build_message_set(message_uids)
+        self.archive_messages(message_sets, mailbox)
 
-        if not self.dry_run:
-            type, data = self.connection.uid("move", message_set, self.quote_mailbox(archive_mailbox))
+    def archive_messages(self, message_sets, mailbox):
+        """
+        Move each message set to its archive mailbox, creating the
+        mailboxes if needed
+        """
+
+        commands = []
+        destinations = []
+
+        for archive_mailbox, (message_set, count) in message_sets.items():
+            with self.lock:
+                if archive_mailbox not in self.archive_mailboxes:
+                    self.create_archive_mailbox(archive_mailbox)
 
+            print("Archiving %d message(s) from %s to %s" % (count, mailbox, archive_mailbox))
+
+            for part in self.split_message_set(message_set):
+                commands.append(("MOVE", part, self.quote_mailbox(archive_mailbox)))
+                destinations.append(archive_mailbox)
+
+        if self.dry_run:
+            return
+
+        for archive_mailbox, (tag, type, data) in zip(destinations, self.pipeline_uid(commands)):
             if type != "OK":
                 raise Exception("Failed to move messages from %s to %s" % (mailbox, archive_mailbox))
 
+    def pipeline_uid(self, commands):
+        """
+        Send several UID commands before waiting for any of the replies
+        so they share a single round trip, returning the tag, type and
+        data of each
+        """
+
+        tags = [self.connection._command("UID", *command) for command in commands]
+        results = []
+        error = None
+
+        # Read every reply before raising so none are left on the
+        # connection to be mistaken for the results of later commands
+        for tag in tags:
+            try:
+                results.append((tag,) + self.connection._command_complete("UID", tag))
+            except self.connection.abort:
+                raise
+            except self.connection.error as e:
+                error = error or e
+
+        if error is not None:
+            raise error
+
+        return results
+
     def build_message_set(self, message_uids):
         """Compress the message UIDs into sets"""
 
-        sets = []
-        set = None
+        # Find the index of each UID which doesn't follow on from the
+        # previous one, giving the boundaries of the consecutive runs
+        breaks = [i for i, (a, b) in enumerate(zip(message_uids, message_uids[1:]), 1) if b - a != 1]
+        starts = [0] + breaks
+        ends = [i - 1 for i in breaks] + [len(message_uids) - 1]
+
+        return ",".join([
+            "%d:%d" % (message_uids[start], message_uids[end]) if start != end else str(message_uids[start])
+            for start, end in zip(starts, ends)
+        ])
+
+    def split_message_set(self, message_set):
+        """
+        Split the message set into pieces short enough to send in a
+        single command
+        """
+
+        if len(message_set) <= _MAX_MESSAGE_SET_LENGTH:
+            return [message_set]
 
-        for message_uid in message_uids:
-            if set is None:
-                set = [message_uid]
-            elif set and set[-1] == message_uid - 1:
-                set.append(message_uid)
-            else:
-                sets.append(set)
-                set = [message_uid]
+        parts = []
+        part = []
+        length = 0
 
-        sets.append(set)
+        for item in message_set.split(","):
+            if part and length + len(item) + 1 > _MAX_MESSAGE_SET_LENGTH:
+                parts.append(",".join(part))
+                part = []
+                length = 0
 
-        return ",".join(map(lambda x: "%s:%s" % (x[0], x[-1]) if len(x) > 1 else str(x[0]), sets))
+            part.append(item)
+            length += len(item) + 1
 
-    def build_archive_mailbox(self, date, mailbox):
-        """Build the name of the archive mailbox"""
+        parts.append(",".join(part))
 
-        mailbox_name = "%s.%d.%s" % (self.archive_mailbox_name, date.year, mailbox)
+        return parts
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def build_archive_mailbox(archive_mailbox_name, year, mailbox):
+        """
+        Build the name of the archive mailbox, cached as only a few
+        years are seen for each mailbox
+        """
+
+        mailbox_name = "%s.%d.%s" % (archive_mailbox_name, year, mailbox)
         return mailbox_name.replace(".INBOX", "")
 
     def create_archive_mailbox(self, mailbox_name):
-        """Create the archive mailbox and add it to the list"""
+        """Create the archive mailbox and add it to the set"""
 
         print("Creating new archive mailbox %s" % mailbox_name)
 
         if not self.dry_run:
             self.connection.create(self.quote_mailbox(mailbox_name))
 
-        self.archive_mailboxes.append(mailbox_name)
+        self.archive_mailboxes.add(mailbox_name)
 
     def select_mailbox(self, mailbox):
         """Open the given mailbox in read/write mode"""
@@ -107,54 +275,126 @@ class ImapArchiver(object):
 
         return "\"%s\"" % mailbox_name
 
-    def get_message_uids(self):
-        """Return the UIDs of the messages in the current mailbox"""
+    def get_max_date(self):
+        """Return the date messages must be older than to be archived"""
 
-        max_date = self.now - datetime.timedelta(days=self.max_age + 1)
-        query = '(BEFORE "%s" NOT FLAGGED)' % max_date.strftime("%d-%b-%Y")
-        type, data = self.connection.uid("search", None, query)
+        return (self.now - datetime.timedelta(days=self.max_age + 1)).date()
 
-        if type != "OK":
-            raise Exception('Could not get message IDs from mailbox "%s"' % mailbox)
+    def format_date(self, date):
+        """Format the date for use in a search query"""
 
-        message_uids = list(map(int, data[0].split()))
-        message_uids.sort()
+        return date.strftime("%d-%b-%Y")
 
-        return message_uids
+    def build_search_query(self, before, since=None):
+        """
+        Build a query matching the unflagged messages received before the
+        given date, and optionally on or after since
+        """
 
-    def get_messages(self, message_uids, mailbox):
+        criteria = ['BEFORE "%s"' % self.format_date(before), "NOT FLAGGED"]
+
+        if since is not None:
+            criteria.insert(0, 'SINCE "%s"' % self.format_date(since))
+
+        return "(%s)" % " ".join(criteria)
+
+    def search_messages(self, mailbox, set_queries, uid_queries):
         """
-        Fetch the dates for the given messages and build the name of
-        the mailboxes to store them in
+        Search the current mailbox with all of the queries, returning the
+        message set and number of matches for each of set_queries and the
+        UIDs matching each of uid_queries.
+
+        Servers supporting ESEARCH return the message sets already
+        compressed and tag each reply, so the searches can be sent in one
+        pipeline. Plain SEARCH replies can't be matched to the command
+        they answer, so those searches are sent one at a time.
         """
 
-        message_set = self.build_message_set(message_uids)
+        queries = set_queries + uid_queries
+
+        if "ESEARCH" in self.connection.capabilities:
+            message_sets = self.esearch_message_sets(mailbox, queries)
+            message_uids = [self.expand_message_set(message_set) for message_set, _ in message_sets[len(set_queries):]]
+        else:
+            message_uids = [self.search_message_uids(mailbox, query) for query in queries]
+            message_sets = [(self.build_message_set(uids) if uids else "", len(uids)) for uids in message_uids]
+            message_uids = message_uids[len(set_queries):]
+
+        return message_sets[:len(set_queries)], message_uids
+
+    def esearch_message_sets(self, mailbox, queries):
+        """
+        Return the message set and number of matches for each query,
+        sending every ESEARCH in one pipeline
+        """
 
-        type, data = self.connection.uid("fetch", message_set, "(UID INTERNALDATE)")
+        self.connection.untagged_responses.pop("ESEARCH", None)
+        results = self.pipeline_uid([("SEARCH", "RETURN (COUNT ALL)", query) for query in queries])
+        data = self.connection.untagged_responses.pop("ESEARCH", [])
+
+        if any(type != "OK" for _, type, _ in results):
+            raise Exception('Could not get message IDs from mailbox "%s"' % mailbox)
+
+        # Each ESEARCH reply names the tag of its command, so match
+        # them up rather than relying on the order they arrive in
+        replies = dict(self.parse_esearch(item) for item in data)
+
+        try:
+            return [replies[tag] for tag, _, _ in results]
+        except KeyError:
+            raise Exception('Could not get message IDs from mailbox "%s"' % mailbox)
+
+    def search_message_uids(self, mailbox, query):
+        """Return the UIDs of the messages matching the query"""
+
+        type, data = self.connection.uid("search", None, query)
 
         if type != "OK":
-            raise Exception("Could not get message dates")
+            raise Exception('Could not get message IDs from mailbox "%s"' % mailbox)
 
-        messages = []
+        return sorted(map(int, data[0].split()))
 
-        for item in data:
-            match = self.pattern.search(item.decode("utf-8"))
+    def expand_message_set(self, message_set):
+        """Return the UIDs in a message set"""
 
-            if match is None:
-                raise Exception("Could not parse message %d data")
+        message_uids = []
 
-            uid = int(match.group(1))
-            date = datetime.datetime.strptime(match.group(2), "%d-%b-%Y %H:%M:%S %z")
-            delta = self.now - date
+        for item in message_set.split(","):
+            if item:
+                first, _, last = item.partition(":")
+                first, last = sorted((int(first), int(last or first)))
+                message_uids.extend(range(first, last + 1))
 
-            messages.append({
-                "uid": uid,
-                "date": date,
-                "age": delta.days,
-                "mailbox": self.build_archive_mailbox(date, mailbox)
-            })
+        return sorted(message_uids)
 
-        return messages
+    def parse_esearch(self, data):
+        """
+        Return the tag of the command an ESEARCH response belongs to,
+        along with its message set and count
+        """
+
+        tag = _ESEARCH_TAG_RE.match(data)
+        count = _ESEARCH_COUNT_RE.search(data)
+        message_set = _ESEARCH_ALL_RE.search(data)
+
+        if tag is None or count is None:
+            raise Exception("Could not parse search result")
+
+        return tag.group(1), (message_set.group(1).decode() if message_set else "", int(count.group(1)))
+
+    def get_messages(self, message_uids, mailbox):
+        """
+        Fetch the years of the given messages and build the name of
+        the mailboxes to store them in, returning a list of archive
+        mailbox and UID pairs
+        """
+
+        message_set = self.build_message_set(message_uids)
+
+        return [
+            (self.build_archive_mailbox(self.archive_mailbox_name, year, mailbox), uid)
+            for uid, year in self.connection.fetch_message_years(message_set)
+        ]
 
     def get_mailboxes_matching(self, pattern):
         """Return the mailboxes matching the given pattern"""
@@ -163,15 +403,30 @@ class ImapArchiver(object):
         status, mailboxes = self.connection.list(pattern)
 
         for mailbox in mailboxes:
-            flags, mailbox_name = mailbox.decode().split(' "." ')
+            match = _LIST_RE.match(mailbox) if isinstance(mailbox, bytes) else None
 
             # Mailboxes with the "Noselect" flag cannot be used
-            if "Noselect" not in flags:
-                mailbox_name = mailbox_name.strip("\"")
-                mailbox_names.append(mailbox_name)
+            if match and b"Noselect" not in match.group(1):
+                mailbox_names.append(match.group(2).decode())
 
         return mailbox_names
 
+def connect(hostname, username, password):
+    """Open and log in to a new connection to the server"""
+
+    try:
+        connection = ArchiverConnection(hostname)
+        connection.login(username, password)
+
+        # Servers may only advertise extensions such as ESEARCH once
+        # logged in, and imaplib doesn't refresh the list itself
+        type, data = connection.capability()
+        connection.capabilities = tuple(data[-1].decode().upper().split())
+    except:
+        raise Exception("Connection failed")
+
+    return connection
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     hostname = "localhost"
@@ -187,15 +442,43 @@ if __name__ == "__main__":
     ]
 
     parser.add_argument("--dry-run", help="Perform dry-run", action="store_true")
+    parser.add_argument("--workers", help="Number of mailboxes to archive at once", type=int, default=4)
     args = parser.parse_args()
 
-    try:
-        connection = imaplib.IMAP4_SSL(hostname)
-        connection.login(username, password)
-    except:
-        raise Exception("Connection failed")
+    # Load the existing archive mailboxes once to share between threads
+    connection = connect(hostname, username, password)
+    archive_mailboxes = ImapArchiver(connection, dry_run=args.dry_run).archive_mailboxes
+    connection.logout()
+
+    lock = threading.Lock()
+    archivers = []
+    local = threading.local()
+
+    def archive_mailbox(mailbox):
+        """Archive the mailbox using the current thread's own connection"""
 
-    archiver = ImapArchiver(connection, dry_run=args.dry_run)
+        if not hasattr(local, "archiver"):
+            local.archiver = ImapArchiver(
+                connect(hostname, username, password),
+                dry_run=args.dry_run,
+                archive_mailboxes=archive_mailboxes,
+                lock=lock
+            )
 
-    for mailbox in mailboxes:
-        archiver.archive_mailbox(mailbox)
+            with lock:
+                archivers.append(local.archiver)
+
+        local.archiver.archive_mailbox(mailbox)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+            for future in [executor.submit(archive_mailbox, mailbox) for mailbox in mailboxes]:
+                future.result()
+    finally:
+        # Connections may already be broken, which mustn't hide the
+        # original error or stop the others from being logged out
+        for archiver in archivers:
+            try:
+                archiver.connection.logout()
+            except Exception:
+                pass